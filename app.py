@@ -1,10 +1,15 @@
 import os
 import uuid
+import mimetypes
 import tempfile
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, flash
-from werkzeug.utils import secure_filename
+from blake3 import blake3
+from flask import Flask, Response, abort, render_template, request, redirect, url_for, send_from_directory, flash
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import FileTarget, ValueTarget
+from werkzeug.security import safe_join
 
 from pdf_preview.core import generate_preview, PDFValidationError
 
@@ -16,55 +21,117 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 OUTPUT_DIR = os.path.join(BASE_DIR, "output")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# Let the front-end web server send downloads instead of a Python worker:
+# - USE_X_SENDFILE=1 emits X-Sendfile (Apache mod_xsendfile, lighttpd)
+# - X_ACCEL_REDIRECT_PREFIX=/_protected/ emits X-Accel-Redirect (nginx internal location)
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE", "") == "1"
+X_ACCEL_REDIRECT_PREFIX = os.environ.get("X_ACCEL_REDIRECT_PREFIX", "")
+
 # Limit upload size to 25 MB (hard cap at server level)
 app.config["MAX_CONTENT_LENGTH"] = 25 * 1024 * 1024
 
+# Generated previews are reused across identical uploads; evict least recently used past this size
+OUTPUT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
 ALLOWED_EXTENSIONS = {"pdf"}
 
+FORM_FIELDS = ("max_duration", "format", "size")
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
 
 def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-@app.route("/", methods=["GET", "POST"])
-def index():
-    if request.method == "GET":
-        return render_template("index.html", error=None)
+def parse_upload(dest_path: str) -> Tuple[Optional[str], Dict[str, str]]:
+    """Stream the multipart body straight to dest_path, returning the client filename and form fields."""
+    parser = StreamingFormDataParser(headers=request.headers)
+    file_target = FileTarget(dest_path)
+    parser.register("file", file_target)
+    value_targets = {name: ValueTarget() for name in FORM_FIELDS}
+    for name, target in value_targets.items():
+        parser.register(name, target)
+
+    # request.stream enforces MAX_CONTENT_LENGTH and raises 413 when exceeded
+    for chunk in iter(lambda: request.stream.read(UPLOAD_CHUNK_SIZE), b""):
+        parser.data_received(chunk)
+
+    form = {name: target.value.decode("utf-8", "replace") for name, target in value_targets.items() if target.value}
+    return file_target.multipart_filename, form
+
+
+def discard(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def cache_key(pdf_path: str, fmt: str, size: str, max_duration: float) -> str:
+    # Key on the PDF contents plus every option that changes the rendered output.
+    # BLAKE3 hashes the memory-mapped upload with SIMD across several threads.
+    h = blake3(max_threads=blake3.AUTO)
+    h.update_mmap(pdf_path)
+    h.update(f"|{fmt}|{size}|{max_duration!r}".encode())
+    return h.hexdigest(16)
+
+
+def prune_output_cache(max_bytes: int = OUTPUT_CACHE_MAX_BYTES) -> None:
+    entries = []
+    for entry in os.scandir(OUTPUT_DIR):
+        if entry.is_file() and not entry.name.startswith("."):
+            st = entry.stat()
+            entries.append((st.st_atime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def process_upload(input_pdf_path: str):
+    """Stream the request into input_pdf_path, then validate and render (or reuse) the preview."""
+    unique_id = str(uuid.uuid4())
+    try:
+        filename, form = parse_upload(input_pdf_path)
+    except ParseFailedException:
+        return render_template("index.html", error="Please choose a PDF file to upload.")
 
-    # POST
-    file = request.files.get("file")
-    if not file or file.filename == "":
+    if not filename:
         return render_template("index.html", error="Please choose a PDF file to upload.")
 
-    if not allowed_file(file.filename):
+    if not allowed_file(filename):
         return render_template("index.html", error="Only PDF files are allowed.")
 
     try:
-        max_duration = float(request.form.get("max_duration", "10"))
+        max_duration = float(form.get("max_duration", "10"))
     except ValueError:
         return render_template("index.html", error="Invalid max duration. Provide a number like 8 or 10.")
 
-    fmt = request.form.get("format", "gif").lower()
+    fmt = form.get("format", "gif").lower()
     if fmt not in {"gif", "mp4"}:
         return render_template("index.html", error="Invalid format selected.")
 
-    size = request.form.get("size", "medium").lower()
+    size = form.get("size", "medium").lower()
     if size not in {"small", "medium", "large"}:
         return render_template("index.html", error="Invalid size selected.")
 
-    # Save to temp dir
-    unique_id = str(uuid.uuid4())
-    upload_tmp_dir = tempfile.gettempdir()
-    safe_name = secure_filename(file.filename)
-    # Force .pdf extension
-    if not safe_name.lower().endswith(".pdf"):
-        safe_name += ".pdf"
-    input_pdf_path = os.path.join(upload_tmp_dir, f"{unique_id}.pdf")
-    file.save(input_pdf_path)
+    # Reuse a previous render of the same PDF and options if we still have it
+    key = cache_key(input_pdf_path, fmt, size, max_duration)
+    cached_path = os.path.join(OUTPUT_DIR, f"{key}.{fmt}")
+    if os.path.isfile(cached_path):
+        os.utime(cached_path)  # mark as recently used for the LRU sweep
+        return render_template("result.html", files=[os.path.basename(cached_path)], unique_id=unique_id)
 
     # Generate outputs
     try:
-        output_basename = os.path.join(OUTPUT_DIR, unique_id)
+        # Render under a unique name and move into place so a concurrent request never
+        # serves a partially written cache entry
+        output_basename = os.path.join(OUTPUT_DIR, f"{key}.{unique_id}")
         outputs: List[str] = generate_preview(
             pdf_path=input_pdf_path,
             output_basename=output_basename,
@@ -77,14 +144,41 @@ def index():
     except Exception as e:
         return render_template("index.html", error=f"Failed to generate preview: {e}")
 
-    # Build filenames for rendering
-    rel_files = [os.path.basename(p) for p in outputs]
+    rel_files = []
+    for p in outputs:
+        ext = os.path.splitext(p)[1]
+        final_path = os.path.join(OUTPUT_DIR, f"{key}{ext}")
+        os.replace(p, final_path)
+        rel_files.append(os.path.basename(final_path))
+    prune_output_cache()
+
     return render_template("result.html", files=rel_files, unique_id=unique_id)
-    
+
+
+@app.route("/", methods=["GET", "POST"])
+def index():
+    if request.method == "GET":
+        return render_template("index.html", error=None)
+
+    # POST: stream the upload into a temp file and always remove it once handled
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        input_pdf_path = tmp.name
+    try:
+        return process_upload(input_pdf_path)
+    finally:
+        discard(input_pdf_path)
+
 
 @app.route("/downloads/<path:filename>")
 def downloads(filename: str):
     # Serve generated files from OUTPUT_DIR
+    if X_ACCEL_REDIRECT_PREFIX:
+        path = safe_join(OUTPUT_DIR, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        redirect_to = X_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + filename
+        return Response(headers={"X-Accel-Redirect": redirect_to}, mimetype=mimetype)
     return send_from_directory(OUTPUT_DIR, filename, as_attachment=False)
 
 
@@ -12,7 +12,8 @@ def parse_args():
     parser.add_argument("--format", choices=["gif", "mp4", "all"], default="gif", help='Output format (default: "gif").')
     parser.add_argument("--size", choices=["small", "medium", "large"], default="medium", 
                        help='Output size preset: "small" (320x480), "medium" (480x640), "large" (720x960) (default: "medium").')
-    parser.add_argument("--crossfade", type=float, default=0.15, help="Crossfade duration between pages in seconds (default: 0.15). Uses bright CrossFadeIn transitions.")
+    parser.add_argument("--crossfade", type=float, default=0.15, help="Crossfade duration between pages in seconds (default: 0.15). Each page fades in over the previous one. Shortened automatically when many pages have to fit in the maximum duration.")
+    parser.add_argument("--no-annotations", action="store_true", help="Skip drawing annotations and form fields (faster for annotation-heavy PDFs).")
     return parser.parse_args()
 
 
@@ -36,6 +37,7 @@ def main():
             format=args.format,
             dimensions=args.size,
             crossfade=args.crossfade,
+            annotations=not args.no_annotations,
         )
         print("Success! Generated file(s):")
         for p in outputs:
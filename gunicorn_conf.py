@@ -0,0 +1,23 @@
+import os
+
+import fitz  # PyMuPDF
+
+# PyMuPDF rasterizes while holding the GIL, so concurrency comes from processes
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = max(2, os.cpu_count() or 1)
+# Gunicorn already runs a worker per CPU; a render pool per request on top of that
+# would oversubscribe the machine, so render in-process unless overridden
+os.environ.setdefault("PDF_PREVIEW_RENDER_WORKERS", "1")
+worker_class = "sync"
+# Rendering a 100-page PDF can take a while; don't let the arbiter kill the worker
+timeout = 120
+
+
+def post_fork(server, worker):
+    # Initialize MuPDF and load the base-14 font used below so the first real
+    # request doesn't pay for it
+    with fitz.open() as doc:
+        page = doc.new_page(width=200, height=200)
+        page.insert_text((20, 100), "warm-up", fontsize=12)
+        page.get_pixmap(colorspace=fitz.csRGB, alpha=False)
+    worker.log.info("Warmed up PyMuPDF in worker %s", worker.pid)
@@ -1,13 +1,18 @@
 import os
 import math
 import uuid
-from typing import List, Tuple, Literal, Optional
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import Callable, Iterator, List, Tuple, Literal, Optional
 
 import numpy as np
 import fitz  # PyMuPDF
+from PIL import Image
 
-import moviepy
-from moviepy import ImageClip, CompositeVideoClip
+# Noisy PDFs can emit thousands of MuPDF errors; formatting them all to stderr is
+# wasted work. They are still collected in fitz.TOOLS.mupdf_warnings().
+fitz.TOOLS.mupdf_display_errors(False)
 
 
 class PDFValidationError(ValueError):
@@ -38,7 +43,8 @@ def _parse_dimensions(dimensions: str) -> Tuple[int, int]:
         raise ValueError('Invalid dimensions. Use "small", "medium", "large", or custom format "WIDTHxHEIGHT".')
 
 
-def _validate_pdf(pdf_path: str, max_size_bytes: int = 25 * 1024 * 1024, max_pages: int = 100) -> None:
+def _validate_pdf(pdf_path: str, max_size_bytes: int = 25 * 1024 * 1024, max_pages: int = 100) -> fitz.Document:
+    """Validate the PDF and return it opened, so callers don't parse it a second time. Caller closes it."""
     if not os.path.isfile(pdf_path):
         raise PDFValidationError("Input file does not exist.")
     if not pdf_path.lower().endswith(".pdf"):
@@ -49,72 +55,151 @@ def _validate_pdf(pdf_path: str, max_size_bytes: int = 25 * 1024 * 1024, max_pag
         raise PDFValidationError("PDF exceeds the 25 MB size limit.")
 
     try:
-        with fitz.open(pdf_path) as doc:
-            page_count = doc.page_count
+        doc = fitz.open(pdf_path)
+        page_count = doc.page_count
     except Exception:
         raise PDFValidationError("Failed to open PDF. The file may be corrupted or not a valid PDF.")
 
     if page_count > max_pages:
+        doc.close()
         raise PDFValidationError(f"PDF exceeds the maximum page count of {max_pages} (found {page_count}).")
+    return doc
 
 
 def _select_pages(total_pages: int, max_duration: float, min_per_page: float, crossfade: float) -> List[int]:
     # Find the maximum number of pages we can show within max_duration given min_per_page and crossfade
-    # Total duration approx: n * per_page - (n - 1) * crossfade
-    # We must keep per_page >= min_per_page, so try increasing n until duration exceeds max_duration
-    n = 1
-    while True:
-        duration = n * min_per_page - (n - 1) * crossfade
-        if duration > max_duration:
-            n -= 1
-            break
-        n += 1
-        if n > total_pages:
-            n = total_pages
-            break
-    n = max(1, n)
+    # Total duration approx: n * per_page - (n - 1) * crossfade = n * (per_page - crossfade) + crossfade
+    # With per_page = min_per_page this solves directly for the largest n that fits.
+    # generate_preview clamps crossfade below min_per_page, so the step is positive.
+    n = math.floor((max_duration - crossfade) / (min_per_page - crossfade) + 1e-9)
+    n = max(1, min(total_pages, n))
 
     if total_pages <= n:
         return list(range(total_pages))
 
-    # Sample evenly, ensuring we include first and last
-    indices = [0]
-    if n > 2:
-        # Evenly space n-2 indices between 1 and total_pages-2 inclusive
-        step = (total_pages - 1) / (n - 1)
-        for i in range(1, n - 1):
-            idx = round(i * step)
-            indices.append(idx)
-    indices.append(total_pages - 1)
-    # Deduplicate and sort
-    indices = sorted(set(indices))
-    # If deduplication reduced count, fill in as best as possible
-    while len(indices) < n:
-        for k in range(total_pages):
-            if k not in indices:
-                indices.append(k)
-            if len(indices) == n:
-                break
-    return sorted(indices)
-
-
-def _render_page_to_array(page: fitz.Page, target_w: int, target_h: int) -> np.ndarray:
+    # Sample evenly, always including first and last. Spacing is at least one page, so
+    # rounding never collides and no refill pass is needed.
+    return np.unique(np.round(np.linspace(0, total_pages - 1, max(n, 2))).astype(int)).tolist()
+
+
+def _fills_target(rect: fitz.Rect, target_w: int, target_h: int) -> bool:
+    # True when the scaled page covers the whole canvas, i.e. no letterboxing is needed
+    scale = min(target_w / rect.width, target_h / rect.height)
+    return math.ceil(rect.width * scale) >= target_w and math.ceil(rect.height * scale) >= target_h
+
+
+def _render_page_to_array(
+    page: fitz.Page, target_w: int, target_h: int, out: Optional[np.ndarray] = None, annots: bool = True
+) -> np.ndarray:
     # Compute scale so the longer side fits within target while preserving aspect ratio
     rect = page.rect
     page_w, page_h = rect.width, rect.height
     scale = min(target_w / page_w, target_h / page_h)
-    # Avoid zero scale for tiny target sizes
-    scale = max(scale, 0.1)
+    fills = _fills_target(rect, target_w, target_h)
+    if fills:
+        # The page matches the target aspect ratio, so the pixmap is the whole canvas
+        out_w, out_h = target_w, target_h
+    else:
+        # Avoid zero scale for tiny target sizes
+        scale = max(scale, 0.1)
+        # Only rasterize the area that lands on the canvas; the clip also keeps the
+        # 0.1 floor above from producing a pixmap larger than the target
+        out_w = max(1, min(target_w, math.ceil(page_w * scale)))
+        out_h = max(1, min(target_h, math.ceil(page_h * scale)))
+    clip = fitz.Rect(rect.x0, rect.y0, rect.x0 + out_w / scale, rect.y0 + out_h / scale)
+
+    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), clip=clip, colorspace=fitz.csRGB, alpha=False, annots=annots)
+    # samples_mv views the pixmap's buffer without materializing a bytes copy; it is
+    # only valid while `pix` is alive, which covers the copy onto the canvas below
+    img = np.asarray(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, 3)
+    img = img[:target_h, :target_w]
+
+    canvas = out if out is not None else np.empty((target_h, target_w, 3), dtype=np.uint8)
+    if fills and img.shape[:2] == (target_h, target_w):
+        # Exact fit: no offsets or border strips, just copy the raster over
+        canvas[...] = img
+        return canvas
+
+    # Letterbox/pad to exact dimensions on white background. The page covers most of
+    # the canvas, so only the border strips around it are painted white.
+    ih, iw = img.shape[:2]
+    y_off = (target_h - ih) // 2
+    x_off = (target_w - iw) // 2
+    if ih != target_h:
+        canvas[:y_off] = 255
+        canvas[y_off + ih:] = 255
+    if iw != target_w:
+        canvas[y_off:y_off + ih, :x_off] = 255
+        canvas[y_off:y_off + ih, x_off + iw:] = 255
+    canvas[y_off:y_off + ih, x_off:x_off + iw] = img
+    return canvas
 
-    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), colorspace=fitz.csRGB, alpha=False)
-    img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, 3)
 
-    # Letterbox/pad to exact dimensions on white background
-    canvas = np.full((target_h, target_w, 3), 255, dtype=np.uint8)
-    y_off = (target_h - img.shape[0]) // 2
-    x_off = (target_w - img.shape[1]) // 2
-    canvas[y_off:y_off + img.shape[0], x_off:x_off + img.shape[1]] = img
-    return canvas
+# Per-process cache of opened documents, keyed by (pid, path), so each pool worker
+# parses the PDF once rather than once per page.
+_worker_docs = {}
+
+
+def _get_worker_doc(pdf_path: str) -> fitz.Document:
+    key = (os.getpid(), pdf_path)
+    doc = _worker_docs.get(key)
+    if doc is None:
+        doc = fitz.open(pdf_path)
+        _worker_docs[key] = doc
+    return doc
+
+
+def _init_render_worker(pdf_path: str) -> None:
+    _get_worker_doc(pdf_path)
+
+
+def _render_one(pdf_path: str, target_w: int, target_h: int, annots: bool, idx: int) -> np.ndarray:
+    doc = _get_worker_doc(pdf_path)
+    return _render_page_to_array(doc.load_page(idx), target_w, target_h, annots=annots)
+
+
+def _default_render_workers() -> int:
+    # PDF_PREVIEW_RENDER_WORKERS lets deployments that already run one process per CPU
+    # (e.g. Gunicorn) turn the render pool off by setting it to 1
+    env = os.environ.get("PDF_PREVIEW_RENDER_WORKERS")
+    if env:
+        try:
+            return max(1, int(env))
+        except ValueError:
+            pass
+    # Respect CPU affinity/cgroup pinning where the platform exposes it
+    if hasattr(os, "sched_getaffinity"):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    return min(cpus, 4)
+
+
+def _render_pages(
+    doc: fitz.Document,
+    pdf_path: str,
+    indices: List[int],
+    target_w: int,
+    target_h: int,
+    annots: bool = True,
+    max_workers: Optional[int] = None,
+) -> np.ndarray:
+    """Render the selected pages into one contiguous (n_pages, target_h, target_w, 3) uint8 array."""
+    frames = np.empty((len(indices), target_h, target_w, 3), dtype=np.uint8)
+
+    # PyMuPDF holds the GIL while rasterizing, so only processes scale. Small jobs and
+    # single-worker setups stay sequential since a pool would only add fork and
+    # pickling overhead.
+    workers = min(max_workers or _default_render_workers(), len(indices))
+    if len(indices) <= 2 or workers < 2:
+        for i, idx in enumerate(indices):
+            _render_page_to_array(doc.load_page(idx), target_w, target_h, out=frames[i], annots=annots)
+        return frames
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker, initargs=(pdf_path,)) as ex:
+        for i, canvas in enumerate(ex.map(partial(_render_one, pdf_path, target_w, target_h, annots), indices)):
+            frames[i] = canvas
+    return frames
 
 
 def _compute_per_page_duration(n_pages: int, max_duration: float, min_per_page: float, crossfade: float) -> float:
@@ -124,6 +209,140 @@ def _compute_per_page_duration(n_pages: int, max_duration: float, min_per_page:
     return max(min_per_page, upper)
 
 
+def _fit_crossfade(n_pages: int, max_duration: float, crossfade: float, select_crossfade: float) -> float:
+    # With d = (max_duration + (n - 1) * c) / n, keeping each fade within half a page's
+    # slot (c <= d / 2) works out to c <= max_duration / (n + 1). Shorten the requested
+    # fade only when that bound bites, and never below the value pages were selected with,
+    # which already fits by construction.
+    return max(select_crossfade, min(crossfade, max_duration / (n_pages + 1)))
+
+
+def _iter_frames(
+    frames: np.ndarray, per_page: float, crossfade: float, total_duration: float, fps: int
+) -> Iterator[Tuple[Optional[int], np.ndarray]]:
+    """Yield (page_index, frame) per output frame; page_index is None for crossfade blends."""
+    # Page i starts at i * step and fades in over the first `crossfade` seconds on top of
+    # page i - 1. Outside those windows the rendered page is yielded as-is, without a copy.
+    # Blended frames reuse one output buffer, so consumers must use each frame before
+    # asking for the next.
+    step = per_page - crossfade
+    n_frames = max(1, math.ceil(total_duration * fps - 1e-9))
+    diff: Optional[np.ndarray] = None
+    blend: Optional[np.ndarray] = None
+    for f in range(n_frames):
+        t = f / fps
+        i = min(int(t // step), len(frames) - 1)
+        local = t - i * step
+        if i == 0 or local >= crossfade:
+            yield i, frames[i]
+            continue
+        if diff is None:
+            diff = np.empty(frames.shape[1:], dtype=np.int16)
+            blend = np.empty(frames.shape[1:], dtype=np.uint8)
+        # Integer lerp B + ((A - B) * alpha) >> 7 in int16, avoiding float conversions.
+        # Q7 keeps (A - B) * alpha within int16 range.
+        alpha_q7 = int(local / crossfade * 128)
+        a, b = frames[i], frames[i - 1]
+        np.subtract(a, b, out=diff, dtype=np.int16)
+        np.multiply(diff, alpha_q7, out=diff)
+        np.right_shift(diff, 7, out=diff)
+        np.add(b, diff, out=blend, casting="unsafe")
+        yield None, blend
+
+
+def _write_gif(gif_path: str, pages: np.ndarray, frames: Iterator[Tuple[Optional[int], np.ndarray]], fps: int) -> None:
+    # One adaptive palette, built from a downsampled strip of every rendered page, is
+    # shared by all frames so Pillow never has to compute a palette per frame
+    strided = pages[:, ::4, ::4]
+    sample = strided.reshape(-1, strided.shape[2], 3)
+    palette = Image.fromarray(sample).quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+
+    def to_indexed(frame: np.ndarray) -> Image.Image:
+        return Image.fromarray(frame).quantize(palette=palette, dither=Image.Dither.NONE)
+
+    # Each page is quantized to a palette-indexed image once and hold frames reuse it;
+    # only crossfade frames are quantized individually. GIF frames are kept at 1 byte
+    # per pixel.
+    indexed = [to_indexed(p) for p in pages]
+    images = [indexed[i] if i is not None else to_indexed(f) for i, f in frames]
+    images[0].save(
+        gif_path,
+        save_all=True,
+        append_images=images[1:],
+        duration=round(1000 / fps),
+        loop=0,
+        disposal=1,
+        optimize=False,
+    )
+
+
+# Hardware H.264 encoders in order of preference, with the ffmpeg options each needs
+_HW_ENCODERS = [
+    ("h264_nvenc", ["-preset", "p1"], "yuv420p"),
+    ("h264_videotoolbox", [], "yuv420p"),
+    ("h264_qsv", ["-preset", "veryfast"], "nv12"),
+]
+_SW_ENCODER = ("libx264", ["-preset", "veryfast"], "yuv420p")
+
+
+def _encoder_works(ffmpeg: str, codec: str, params: List[str], pix_fmt: str) -> bool:
+    # Builds often list encoders whose device or driver is missing, so encode a
+    # single tiny frame with the same options _write_mp4 will use
+    cmd = [ffmpeg, "-hide_banner", "-loglevel", "error", "-f", "lavfi", "-i", "color=size=64x64",
+           "-frames:v", "1", "-c:v", codec, "-pix_fmt", pix_fmt, *params, "-f", "null", "-"]
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=15).returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+
+@lru_cache(maxsize=None)
+def _pick_h264_encoder() -> Tuple[str, Tuple[str, ...], str]:
+    """Return (codec, ffmpeg_params, pixelformat) for the fastest usable H.264 encoder."""
+    import imageio_ffmpeg
+
+    ffmpeg = imageio_ffmpeg.get_ffmpeg_exe()
+    try:
+        listing = subprocess.run([ffmpeg, "-hide_banner", "-encoders"], capture_output=True, timeout=15).stdout.decode()
+    except (OSError, subprocess.SubprocessError):
+        listing = ""
+    for codec, params, pix_fmt in _HW_ENCODERS:
+        if codec in listing and _encoder_works(ffmpeg, codec, params, pix_fmt):
+            return codec, tuple(params), pix_fmt
+    codec, params, pix_fmt = _SW_ENCODER
+    return codec, tuple(params), pix_fmt
+
+
+def _write_mp4(mp4_path: str, make_frames: Callable[[], Iterator[Tuple[Optional[int], np.ndarray]]], fps: int) -> None:
+    # The ffmpeg stack is only imported when an MP4 is requested; GIF output is
+    # written by Pillow in a single pass and never touches it
+    import imageio
+
+    def encode(codec: str, params: List[str], pix_fmt: str) -> None:
+        # yuv420p needs even dimensions; a block size of 2 avoids resizing preset sizes
+        with imageio.get_writer(
+            mp4_path,
+            fps=fps,
+            codec=codec,
+            pixelformat=pix_fmt,
+            ffmpeg_params=list(params),
+            macro_block_size=2,
+        ) as writer:
+            for _, frame in make_frames():
+                writer.append_data(frame)
+
+    codec, params, pix_fmt = _pick_h264_encoder()
+    if codec == _SW_ENCODER[0]:
+        encode(*_SW_ENCODER)
+        return
+    try:
+        encode(codec, list(params), pix_fmt)
+    except (OSError, RuntimeError):
+        # A hardware encoder can pass the probe and still fail on the real input
+        # (e.g. size limits or a busy device); redo the file with libx264
+        encode(*_SW_ENCODER)
+
+
 def generate_preview(
     pdf_path: str,
     output_basename: str,
@@ -133,6 +352,8 @@ def generate_preview(
     crossfade: float = 0.15,
     fps_gif: int = 15,
     fps_mp4: int = 24,
+    annotations: bool = True,
+    render_workers: Optional[int] = None,
 ) -> List[str]:
     """
     Convert a PDF into an animated preview (GIF/MP4) with crossfades.
@@ -147,8 +368,15 @@ def generate_preview(
                    - "medium": 480x640 (balanced default) 
                    - "large": 720x960 (high quality)
         crossfade: Crossfade duration between pages in seconds (0.1 to 0.2 suggested).
+                   Shortened when needed so each fade stays within half a page's
+                   display time and the animation fits max_duration.
         fps_gif: Frame rate for GIF output.
         fps_mp4: Frame rate for MP4 output.
+        annotations: Render annotations and form fields. Disable to skip drawing them
+                     on annotation-heavy PDFs.
+        render_workers: Processes used to render pages. Defaults to
+                        PDF_PREVIEW_RENDER_WORKERS, else the available CPUs (max 4).
+                        1 renders in-process.
 
     Returns:
         List of generated file paths.
@@ -163,51 +391,23 @@ def generate_preview(
         raise ValueError("crossfade must be between 0 and 1 second for best results.")
     target_w, target_h = _parse_dimensions(dimensions)
 
-    _validate_pdf(pdf_path)
-
     outputs: List[str] = []
     min_per_page = 0.4
 
-    with fitz.open(pdf_path) as doc:
+    with _validate_pdf(pdf_path) as doc:
         total_pages = doc.page_count
-        indices = _select_pages(total_pages, max_duration, min_per_page, crossfade)
+        # Select pages assuming fades no longer than half the minimum page time, then
+        # give back as much of the requested fade as the chosen page count allows
+        select_crossfade = min(crossfade, min_per_page / 2)
+        indices = _select_pages(total_pages, max_duration, min_per_page, select_crossfade)
+        crossfade = _fit_crossfade(len(indices), max_duration, crossfade, select_crossfade)
 
         per_page = _compute_per_page_duration(len(indices), max_duration, min_per_page, crossfade)
 
         # Render images
-        frames: List[np.ndarray] = []
-        for idx in indices:
-            page = doc.load_page(idx)
-            frames.append(_render_page_to_array(page, target_w, target_h))
-
-    # Build ImageClips with durations
-    clips: List[ImageClip] = []
-    for i, frame in enumerate(frames):
-        clip = ImageClip(frame).with_duration(per_page)
-        if i > 0 and crossfade > 0:
-            # We'll apply crossfade-in via CompositeVideoClip start times later
-            pass
-        clips.append(clip)
-
-    # Create smooth crossfade using CrossFadeIn for bright transitions
-    if len(clips) == 1 or crossfade <= 0:
-        final = CompositeVideoClip([clips[0].with_start(0)], size=(target_w, target_h), bg_color=(255, 255, 255)).with_duration(per_page)
-    else:
-        placed = []
-        for i, c in enumerate(clips):
-            start = i * (per_page - crossfade)
-            c = c.with_start(start)
-            
-            if i > 0:
-                # Use CrossFadeIn for smooth, bright transitions
-                c = c.with_effects([moviepy.vfx.CrossFadeIn(crossfade)])
-            
-            placed.append(c)
-        
-        total_duration = (len(clips) - 1) * (per_page - crossfade) + per_page
-        # Ensure bright white background throughout
-        final = CompositeVideoClip(placed, size=(target_w, target_h), bg_color=(255, 255, 255)).with_duration(total_duration)
+        frames = _render_pages(doc, pdf_path, indices, target_w, target_h, annots=annotations, max_workers=render_workers)
 
+    total_duration = (len(frames) - 1) * (per_page - crossfade) + per_page
 
     # Write outputs
     output_dir = os.path.dirname(output_basename)
@@ -217,18 +417,24 @@ def generate_preview(
     if fmt not in {"gif", "mp4", "all"}:
         raise ValueError('format must be one of: "gif", "mp4", "all".')
 
+    writers = []
     if fmt in {"gif", "all"}:
         gif_path = f"{output_basename}.gif"
-        final.write_gif(gif_path, fps=fps_gif)
+        writers.append(partial(_write_gif, gif_path, frames, _iter_frames(frames, per_page, crossfade, total_duration, fps_gif), fps_gif))
         outputs.append(gif_path)
 
     if fmt in {"mp4", "all"}:
         mp4_path = f"{output_basename}.mp4"
-        final.write_videofile(mp4_path, codec="libx264", audio=False, fps=fps_mp4)
+        writers.append(partial(_write_mp4, mp4_path, partial(_iter_frames, frames, per_page, crossfade, total_duration, fps_mp4), fps_mp4))
         outputs.append(mp4_path)
 
-    final.close()
-    for c in clips:
-        c.close()
+    if len(writers) == 1:
+        writers[0]()
+    else:
+        # The outputs only read the shared frames; ffmpeg encodes in its own process,
+        # so the GIF can be quantized while the MP4 is being encoded
+        with ThreadPoolExecutor(max_workers=len(writers)) as ex:
+            for future in [ex.submit(w) for w in writers]:
+                future.result()
 
     return outputs
\ No newline at end of file